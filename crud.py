@@ -1,29 +1,104 @@
-from sqlalchemy import select
-from models import User, Message
-from typing import Dict
+from sqlalchemy import DateTime, bindparam, insert, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import User, Message, ConversationState
+from typing import Dict, List, NamedTuple
+
+from cachetools import TTLCache
+
+# Hot statements are built once with bind parameters so calls skip rebuilding
+# the select() and hit SQLAlchemy's compiled cache.
+_STMT_USER_BY_NICK = select(User).where(User.nickname == bindparam("nick"))
+_STMT_USERS = select(User)
+_STMT_USERS_BY_IDS = select(User).where(User.id.in_(bindparam("ids", expanding=True)))
+_STMT_MESSAGES_BETWEEN = (
+    select(Message)
+    .where(
+        ((Message.sender_id == bindparam("a")) & (Message.recipient_id == bindparam("b")))
+        | ((Message.sender_id == bindparam("b")) & (Message.recipient_id == bindparam("a")))
+    )
+    .order_by(Message.timestamp)
+)
 
 async def get_user_by_nickname(db, nickname: str):
-    result = await db.execute(select(User).where(User.nickname == nickname))
+    result = await db.execute(_STMT_USER_BY_NICK, {"nick": nickname})
     return result.scalar_one_or_none()
 
+class CachedUser(NamedTuple):
+    id: int
+    nickname: str
+    instruction: str
+    outgoing_instruction: str
+
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL_SEC = 300.0
+# Tunes read on every websocket send; entries are refreshed by the write helpers,
+# and the TTL heals any invalidation that gets missed.
+_USER_CACHE: TTLCache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SEC)
+# Bumped on every write or invalidation so a load that raced with one is not cached
+_USER_GENERATION: Dict[int, int] = {}
+
+def _to_cached(user: User) -> CachedUser:
+    return CachedUser(
+        id=user.id,
+        nickname=user.nickname,
+        instruction=user.instruction or "",
+        outgoing_instruction=user.outgoing_instruction or "",
+    )
+
+def _bump_generation(user_id: int):
+    _USER_GENERATION[user_id] = _USER_GENERATION.get(user_id, 0) + 1
+
+def _cache_user(user: User) -> CachedUser:
+    _bump_generation(user.id)
+    entry = _to_cached(user)
+    _USER_CACHE[user.id] = entry
+    return entry
+
+def invalidate_user(user_id: int):
+    _bump_generation(user_id)
+    _USER_CACHE.pop(user_id, None)
+
 async def create_user(db, nickname: str):
     user = User(nickname=nickname)
     db.add(user)
     await db.commit()
-    await db.refresh(user)
+    _cache_user(user)
     return user
 
 async def get_users(db):
-    result = await db.execute(select(User))
+    result = await db.execute(_STMT_USERS)
     return result.scalars().all()
 
+async def get_users_by_ids(db, user_ids) -> Dict[int, User]:
+    result = await db.execute(_STMT_USERS_BY_IDS, {"ids": list(set(user_ids))})
+    return {user.id: user for user in result.scalars()}
+
+async def get_users_cached(db, user_ids) -> Dict[int, CachedUser]:
+    found: Dict[int, CachedUser] = {}
+    missing = []
+    for uid in set(user_ids):
+        entry = _USER_CACHE.get(uid)
+        if entry is None:
+            missing.append(uid)
+        else:
+            found[uid] = entry
+    if missing:
+        generations = {uid: _USER_GENERATION.get(uid, 0) for uid in missing}
+        for user in (await get_users_by_ids(db, missing)).values():
+            entry = _to_cached(user)
+            # Skip the store if an update landed while we were loading the old row
+            if _USER_GENERATION.get(user.id, 0) == generations[user.id]:
+                _USER_CACHE[user.id] = entry
+            found[user.id] = entry
+    return found
+
 async def update_instruction(db, user_id: int, instruction: str):
     user = await db.get(User, user_id)
     if not user:
         return None
     user.instruction = instruction or ""
     await db.commit()
-    await db.refresh(user)
+    _cache_user(user)
     return user
 
 async def update_outgoing_instruction(db, user_id: int, instruction: str):
@@ -32,7 +107,7 @@ async def update_outgoing_instruction(db, user_id: int, instruction: str):
         return None
     user.outgoing_instruction = instruction or ""
     await db.commit()
-    await db.refresh(user)
+    _cache_user(user)
     return user
 
 async def create_message(
@@ -45,7 +120,7 @@ async def create_message(
     outgoing_instruction,
     instruction,
 ):
-    msg = Message(
+    values = dict(
         sender_id=sender_id,
         recipient_id=recipient_id,
         original_text=original_text,
@@ -54,59 +129,58 @@ async def create_message(
         instruction_used=instruction,
         outgoing_instruction_used=outgoing_instruction,
     )
-    db.add(msg)
+    stmt = insert(Message).values(**values).returning(Message.id, Message.timestamp)
+    row = (await db.execute(stmt)).one()
+    msg = Message(id=row.id, timestamp=row.timestamp, **values)
+    await _record_last_message(db, msg)
     await db.commit()
-    await db.refresh(msg)
     return msg
 
-async def get_messages(db, sender_id, recipient_id):
-    stmt = (
-        select(Message)
-        .where(
-            ((Message.sender_id == sender_id) & (Message.recipient_id == recipient_id))
-            | ((Message.sender_id == recipient_id) & (Message.recipient_id == sender_id))
-        )
-        .order_by(Message.timestamp)
+async def _record_last_message(db, msg: Message):
+    stmt = sqlite_insert(ConversationState).values(
+        user_a=min(msg.sender_id, msg.recipient_id),
+        user_b=max(msg.sender_id, msg.recipient_id),
+        last_message_id=msg.id,
+        last_timestamp=msg.timestamp,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ConversationState.user_a, ConversationState.user_b],
+        set_={
+            "last_message_id": stmt.excluded.last_message_id,
+            "last_timestamp": stmt.excluded.last_timestamp,
+        },
+        where=ConversationState.last_message_id < stmt.excluded.last_message_id,
     )
-    result = await db.execute(stmt)
+    await db.execute(stmt)
+
+async def get_messages(db, sender_id, recipient_id):
+    result = await db.execute(_STMT_MESSAGES_BETWEEN, {"a": sender_id, "b": recipient_id})
     return result.scalars().all()
 
-async def get_conversation_summaries(db, user_id: int) -> Dict[int, dict]:
-    users_result = await db.execute(select(User))
-    users = {user.id: user for user in users_result.scalars().all() if user.id != user_id}
-    summaries: Dict[int, dict] = {
-        uid: {
-            "peer_id": uid,
-            "nickname": users[uid].nickname,
-            "last_message_id": None,
-            "last_message_sender_id": None,
-            "last_message_text": None,
-            "last_message_timestamp": None,
-        }
-        for uid in users
-    }
-
-    msgs_result = await db.execute(
-        select(Message)
-        .where((Message.sender_id == user_id) | (Message.recipient_id == user_id))
-        .order_by(Message.timestamp.desc())
-    )
-    for msg in msgs_result.scalars():
-        peer_id = msg.recipient_id if msg.sender_id == user_id else msg.sender_id
-        if peer_id not in summaries:
-            continue
-        summary = summaries[peer_id]
-        if summary["last_message_id"] is not None:
-            continue
-        mine = msg.sender_id == user_id
-        text = (
-            (msg.outgoing_text or msg.rephrased_text or msg.original_text or "")
-            if mine
-            else (msg.rephrased_text or msg.outgoing_text or msg.original_text or "")
-        )
-        summary["last_message_id"] = msg.id
-        summary["last_message_sender_id"] = msg.sender_id
-        summary["last_message_text"] = text
-        summary["last_message_timestamp"] = msg.timestamp
-
-    return summaries
+_CONVERSATION_SUMMARIES_SQL = text(
+    """
+    SELECT
+        u.id AS peer_id,
+        u.nickname AS nickname,
+        m.id AS last_message_id,
+        m.sender_id AS last_message_sender_id,
+        CASE
+            WHEN m.id IS NULL THEN NULL
+            WHEN m.sender_id = :uid THEN COALESCE(m.outgoing_text, m.rephrased_text, m.original_text, '')
+            ELSE COALESCE(m.rephrased_text, m.outgoing_text, m.original_text, '')
+        END AS last_message_text,
+        cs.last_timestamp AS last_message_timestamp
+    FROM users u
+    LEFT JOIN conversation_state cs
+        ON cs.user_a = CASE WHEN u.id < :uid THEN u.id ELSE :uid END
+        AND cs.user_b = CASE WHEN u.id < :uid THEN :uid ELSE u.id END
+    LEFT JOIN messages m ON m.id = cs.last_message_id
+    WHERE u.id != :uid
+    ORDER BY cs.last_timestamp IS NULL, cs.last_timestamp DESC, lower(u.nickname)
+    """
+).columns(last_message_timestamp=DateTime(timezone=True))
+
+async def get_conversation_summaries(db, user_id: int) -> List[dict]:
+    """Most recent conversations first, then peers without messages by nickname."""
+    result = await db.execute(_CONVERSATION_SUMMARIES_SQL, {"uid": user_id})
+    return [dict(row) for row in result.mappings()]
@@ -1,25 +1,34 @@
 import os
-import json
+import logging
+import asyncio
+import hashlib
 import time
-import subprocess
+import uuid
 import socket
-from typing import Dict, Set
+import sys
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
 
-from fastapi import FastAPI, Depends, HTTPException, Query, WebSocket, WebSocketDisconnect, Response
+import orjson
+import redis.asyncio as aioredis
+from cachetools import TTLCache
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, WebSocket, WebSocketDisconnect, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from openai import AsyncOpenAI, APIConnectionError, APIError, APIStatusError, RateLimitError
+from pydantic import TypeAdapter
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import inspect, text
+from sqlalchemy import DateTime, inspect, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from database import engine, Base, get_db, AsyncSessionLocal
 import crud, models, schemas
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     if not OPENAI_API_KEY:
@@ -27,7 +36,17 @@ async def lifespan(app: FastAPI):
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
         await conn.run_sync(_ensure_schema)
-    yield
+    global redis_client
+    if REDIS_URL:
+        redis_client = aioredis.from_url(REDIS_URL)
+        await manager.start(redis_client)
+    try:
+        yield
+    finally:
+        if redis_client is not None:
+            await manager.stop()
+            await redis_client.aclose()
+            redis_client = None
 
 app = FastAPI(lifespan=lifespan)
 
@@ -41,11 +60,31 @@ app.add_middleware(
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+OPENAI_MAX_INFLIGHT = int(os.getenv("OPENAI_MAX_INFLIGHT", "16"))
+OPENAI_TIMEOUT_SEC = float(os.getenv("OPENAI_TIMEOUT_SEC", "20"))
+openai_slots = asyncio.Semaphore(OPENAI_MAX_INFLIGHT)
+
+REWRITE_CACHE_SIZE = 10000
+REWRITE_CACHE_TTL_SEC = 3600.0
+rewrite_cache: TTLCache = TTLCache(maxsize=REWRITE_CACHE_SIZE, ttl=REWRITE_CACHE_TTL_SEC)
+rewrite_inflight: Dict[bytes, asyncio.Future] = {}
+
+# Presence and websocket routing live in Redis when REDIS_URL is set so that
+# several uvicorn workers can share them; otherwise they stay in-process.
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client: Optional[aioredis.Redis] = None
 
 presence: Dict[int, float] = {}
 PRESENCE_TIMEOUT_SEC = 15.0
+_last_prune = 0.0
 
 def _prune_presence(now: float):
+    # _is_online checks expiry per lookup, so a full sweep is only needed
+    # once per timeout window to keep the dict from growing unbounded.
+    global _last_prune
+    if now - _last_prune < PRESENCE_TIMEOUT_SEC:
+        return
+    _last_prune = now
     stale = [uid for uid, ts in presence.items() if now - ts >= PRESENCE_TIMEOUT_SEC]
     for uid in stale:
         presence.pop(uid, None)
@@ -55,27 +94,24 @@ def _get_local_ip() -> str:
     if env_ip:
         return env_ip
 
-    interfaces = ["en0", "en1", "en2", "p2p0", "eth0", "wlan0"]
-    for iface in interfaces:
-        try:
-            out = subprocess.check_output(["ifconfig", iface], text=True)
-        except Exception:
-            continue
-        for line in out.splitlines():
-            line = line.strip()
-            if line.startswith("inet ") and "127.0.0.1" not in line:
-                parts = line.split()
-                if len(parts) >= 2:
-                    return parts[1]
+    # Connecting a UDP socket sends no packets; it just picks the outbound interface
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+    except OSError:
+        pass
 
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-        s.close()
-        return ip
-    except Exception:
-        return "127.0.0.1"
+        for *_, sockaddr in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            if not sockaddr[0].startswith("127."):
+                return sockaddr[0]
+    except OSError:
+        pass
+    return "127.0.0.1"
+
+# The host address does not change at runtime, so resolve it once
+LOCAL_IP = _get_local_ip()
 
 
 def _ensure_schema(sync_conn):
@@ -91,12 +127,46 @@ def _ensure_schema(sync_conn):
     if "outgoing_instruction_used" not in message_columns:
         sync_conn.execute(text("ALTER TABLE messages ADD COLUMN outgoing_instruction_used TEXT"))
 
-
-async def _rewrite_text(content: str, instruction: str) -> tuple[str, bool, bool]:
-    instr = (instruction or "").strip()
-    if not instr:
-        return content, False, False
-
+    # Backfill the last-message table once for databases that predate it
+    has_state = sync_conn.execute(text("SELECT 1 FROM conversation_state LIMIT 1")).first()
+    if not has_state:
+        # Read timestamps through the typed column and write them back through
+        # ConversationState so they are formatted exactly like the upsert in crud
+        latest = sync_conn.execute(text(
+            """
+            SELECT user_a, user_b, id AS last_message_id, timestamp AS last_timestamp FROM (
+                SELECT
+                    CASE WHEN sender_id < recipient_id THEN sender_id ELSE recipient_id END AS user_a,
+                    CASE WHEN sender_id < recipient_id THEN recipient_id ELSE sender_id END AS user_b,
+                    id,
+                    timestamp,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY
+                            CASE WHEN sender_id < recipient_id THEN sender_id ELSE recipient_id END,
+                            CASE WHEN sender_id < recipient_id THEN recipient_id ELSE sender_id END
+                        ORDER BY timestamp DESC, id DESC
+                    ) AS rn
+                FROM messages
+                WHERE sender_id IS NOT NULL AND recipient_id IS NOT NULL
+            ) AS ranked
+            WHERE rn = 1
+            """
+        ).columns(last_timestamp=DateTime(timezone=True))).mappings().all()
+        if latest:
+            # Every worker runs this at startup; rows a concurrent run already wrote win
+            stmt = sqlite_insert(models.ConversationState.__table__).on_conflict_do_nothing()
+            sync_conn.execute(stmt, [dict(row) for row in latest])
+
+    # checkfirst emits CREATE INDEX only when missing, so concurrent startups don't collide
+    for index in models.Message.__table__.indexes:
+        index.create(sync_conn, checkfirst=True)
+
+
+DeltaCallback = Callable[[str], Awaitable[None]]
+
+async def _request_rewrite(
+    content: str, instr: str, on_delta: Optional[DeltaCallback] = None
+) -> tuple[str, bool, bool]:
     system_prompt = (
         "You are an uncompromising tone-transformer. You receive a STYLE description "
         "and a MESSAGE, and you MUST rewrite the MESSAGE so it matches the STYLE exactly. "
@@ -107,44 +177,118 @@ async def _rewrite_text(content: str, instruction: str) -> tuple[str, bool, bool
         f"MESSAGE:\n{content}\n\n"
         "Rewritten message:"
     )
+    request = dict(
+        model=OPENAI_MODEL,
+        temperature=0.9,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+    )
     try:
-        resp = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            temperature=0.9,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-        )
-        rewritten = resp.choices[0].message.content.strip()
+        # The timeout covers queueing for a slot too, so overload degrades to the
+        # unrewritten fallback instead of stalling the websocket.
+        rewritten = await asyncio.wait_for(_complete(request, on_delta), timeout=OPENAI_TIMEOUT_SEC)
         if rewritten.lower().startswith("rewritten message:"):
             rewritten = rewritten.split(":", 1)[1].strip()
         if not rewritten:
             return content, False, False
         return rewritten, True, False
-    except (APIConnectionError, RateLimitError, APIStatusError, APIError):
+    except (APIConnectionError, RateLimitError, APIStatusError, APIError, asyncio.TimeoutError):
         return content, False, True
     except Exception:
         return content, False, True
 
+async def _complete(request: dict, on_delta: Optional[DeltaCallback]) -> str:
+    async with openai_slots:
+        if on_delta is None:
+            resp = await client.chat.completions.create(**request)
+            return resp.choices[0].message.content.strip()
+        # Forward tokens as they arrive; the joined text is what gets returned
+        stream = await client.chat.completions.create(**request, stream=True)
+        parts: list[str] = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            if delta:
+                parts.append(delta)
+                await on_delta(delta)
+        return "".join(parts).strip()
+
+def _rewrite_key(content: str, instr: str) -> bytes:
+    payload = b"\0".join((OPENAI_MODEL.encode(), instr.encode(), content.encode()))
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+async def _rewrite_text(
+    content: str, instruction: str, on_delta: Optional[DeltaCallback] = None
+) -> tuple[str, bool, bool]:
+    instr = (instruction or "").strip()
+    if not instr:
+        return content, False, False
+
+    key = _rewrite_key(content, instr)
+    cached = rewrite_cache.get(key)
+    if cached is not None:
+        return cached, True, False
+
+    # Coalesce identical rewrites that are already waiting on OpenAI
+    pending = rewrite_inflight.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    future: asyncio.Future = asyncio.get_running_loop().create_future()
+    rewrite_inflight[key] = future
+    try:
+        result = await _request_rewrite(content, instr, on_delta)
+        if result[1]:
+            rewrite_cache[key] = result[0]
+        future.set_result(result)
+        return result
+    finally:
+        rewrite_inflight.pop(key, None)
+        if not future.done():
+            # the owner was cancelled; let any waiters fall back to the original text
+            future.set_result((content, False, True))
+
+# Static filenames are not content-hashed, so pages always revalidate via ETag
+# and other assets get a short max-age rather than being marked immutable.
+HTML_CACHE_CONTROL = "no-cache"
+ASSET_CACHE_CONTROL = "public, max-age=3600"
+HOST_INFO_CACHE_CONTROL = "public, max-age=60"
+
+class CachedStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        is_html = str(full_path).endswith(".html")
+        response.headers["Cache-Control"] = HTML_CACHE_CONTROL if is_html else ASSET_CACHE_CONTROL
+        return response
+
+static_files = CachedStaticFiles(directory="static", html=True)
+
 @app.get("/health")
 async def health():
     return {"ok": True}
 
 
 @app.get("/admin", include_in_schema=False)
-async def admin_page():
-    return FileResponse("static/admin.html")
+async def admin_page(request: Request):
+    # Same revalidation path (ETag, weak validators, 304) as every other page
+    return await static_files.get_response("admin.html", request.scope)
 
 @app.get("/host-info")
-async def host_info():
-    return {"ip": _get_local_ip()}
+async def host_info(response: Response):
+    response.headers["Cache-Control"] = HOST_INFO_CACHE_CONTROL
+    return {"ip": LOCAL_IP}
 
 @app.post("/presence/{user_id}", status_code=204)
 async def presence_ping(user_id: int):
-    now = time.time()
-    presence[user_id] = now
-    _prune_presence(now)
+    if redis_client is not None:
+        await redis_client.set(_presence_key(user_id), "1", ex=int(PRESENCE_TIMEOUT_SEC))
+    else:
+        now = time.monotonic()
+        presence[user_id] = now
+        _prune_presence(now)
     return Response(status_code=204)
 
 @app.post("/register", response_model=schemas.UserOut)
@@ -165,46 +309,58 @@ def _is_online(user_id: int, now: float) -> bool:
     ts = presence.get(user_id)
     return bool(ts and now - ts < PRESENCE_TIMEOUT_SEC)
 
-def _user_to_schema(user: models.User, now: float) -> schemas.UserOut:
+def _presence_key(user_id: int) -> str:
+    return f"presence:{user_id}"
+
+async def _online_ids(user_ids: Iterable[int]) -> Set[int]:
+    user_ids = list(user_ids)
+    if redis_client is not None:
+        if not user_ids:
+            return set()
+        values = await redis_client.mget([_presence_key(uid) for uid in user_ids])
+        return {uid for uid, value in zip(user_ids, values) if value is not None}
+    now = time.monotonic()
+    _prune_presence(now)
+    return {uid for uid in user_ids if _is_online(uid, now)}
+
+def _json_response(adapter: TypeAdapter, items) -> Response:
+    # Serialize straight to JSON bytes instead of letting FastAPI re-validate the list
+    return Response(adapter.dump_json(items), media_type="application/json")
+
+def _user_to_schema(user: models.User, is_online: bool) -> schemas.UserOut:
     return schemas.UserOut(
         id=user.id,
         nickname=user.nickname,
         instruction=user.instruction or "",
         outgoing_instruction=user.outgoing_instruction or "",
-        is_online=_is_online(user.id, now),
+        is_online=is_online,
     )
 
 @app.get("/users", response_model=list[schemas.UserOut])
 async def users(db=Depends(get_db)):
-    now = time.time()
-    _prune_presence(now)
     records = await crud.get_users(db)
-    return [_user_to_schema(user, now) for user in records]
+    online = await _online_ids(user.id for user in records)
+    return _json_response(
+        schemas.USERS_ADAPTER, [_user_to_schema(user, user.id in online) for user in records]
+    )
 
 @app.get("/users/available", response_model=list[schemas.UserOut])
 async def users_available(db=Depends(get_db)):
-    now = time.time()
-    _prune_presence(now)
     records = await crud.get_users(db)
-    return [_user_to_schema(user, now) for user in records if _is_online(user.id, now)]
+    online = await _online_ids(user.id for user in records)
+    return _json_response(
+        schemas.USERS_ADAPTER, [_user_to_schema(user, True) for user in records if user.id in online]
+    )
 
 @app.get("/conversations/{user_id}", response_model=list[schemas.ConversationSummary])
 async def conversations(user_id: int, db=Depends(get_db)):
-    now = time.time()
-    _prune_presence(now)
     summaries = await crud.get_conversation_summaries(db, user_id)
-    output: list[schemas.ConversationSummary] = []
-    for peer_id, payload in summaries.items():
-        payload["is_online"] = _is_online(peer_id, now)
-        output.append(schemas.ConversationSummary(**payload))
-    output.sort(
-        key=lambda item: (
-            item.last_message_timestamp is None,
-            -(item.last_message_timestamp.timestamp()) if item.last_message_timestamp else 0,
-            item.nickname.lower(),
-        )
-    )
-    return output
+    online = await _online_ids(payload["peer_id"] for payload in summaries)
+    output = [
+        schemas.ConversationSummary(**payload, is_online=payload["peer_id"] in online)
+        for payload in summaries
+    ]
+    return _json_response(schemas.CONVERSATIONS_ADAPTER, output)
 
 @app.post("/instruction/{user_id}", response_model=schemas.UserOut)
 async def set_instruction(
@@ -215,6 +371,7 @@ async def set_instruction(
     user = await crud.update_instruction(db, user_id, instruction)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    await manager.invalidate_user(user_id)
     return user
 
 @app.post("/outgoing/{user_id}", response_model=schemas.UserOut)
@@ -226,47 +383,152 @@ async def set_outgoing_instruction(
     user = await crud.update_outgoing_instruction(db, user_id, instruction)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    await manager.invalidate_user(user_id)
     return user
 
 # Keep REST history endpoint (used to bootstrap chat view)
 @app.get("/messages/{sender_id}/{recipient_id}", response_model=list[schemas.MessageOut])
 async def get_msgs(sender_id: int, recipient_id: int, db=Depends(get_db)):
     msgs = await crud.get_messages(db, sender_id, recipient_id)
-    return [schemas.MessageOut.from_orm(m) for m in msgs]
+    return _json_response(
+        schemas.MESSAGES_ADAPTER,
+        schemas.MESSAGES_ADAPTER.validate_python(msgs, from_attributes=True),
+    )
 
 # ---------------------------
 # WebSocket realtime messaging
 # ---------------------------
 
+async def _send(websocket: WebSocket, payload: dict):
+    await websocket.send_bytes(orjson.dumps(payload))
+
+USER_INVALIDATE_CHANNEL = "user:invalidate"
+
+def _user_channel(user_id: int) -> str:
+    return f"user:{user_id}"
+
 class ConnectionManager:
     def __init__(self):
         # user_id -> set of WebSocket connections
         self.active: Dict[int, Set[WebSocket]] = {}
+        self.redis: Optional[aioredis.Redis] = None
+        self.pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self, redis: aioredis.Redis):
+        # Each worker subscribes to user:{id} for the sockets it holds, and
+        # send_to_user publishes so the owning worker delivers the payload.
+        self.redis = redis
+        self.pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.subscribe(USER_INVALIDATE_CHANNEL)
+        self._listener = asyncio.create_task(self._listen())
+        self._listener.add_done_callback(self._listener_done)
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+        self.redis = self.pubsub = self._listener = None
 
     def _bucket(self, user_id: int) -> Set[WebSocket]:
         return self.active.setdefault(user_id, set())
 
     async def connect(self, user_id: int, websocket: WebSocket):
         await websocket.accept()
+        first = user_id not in self.active
         self._bucket(user_id).add(websocket)
+        if first and self.pubsub is not None:
+            await self.pubsub.subscribe(_user_channel(user_id))
 
-    def disconnect(self, user_id: int, websocket: WebSocket):
+    async def disconnect(self, user_id: int, websocket: WebSocket):
         bucket = self.active.get(user_id)
         if bucket and websocket in bucket:
             bucket.remove(websocket)
-        if bucket and not bucket:
+        if bucket is not None and not bucket:
             self.active.pop(user_id, None)
+            if self.pubsub is not None:
+                await self.pubsub.unsubscribe(_user_channel(user_id))
 
     async def send_to_user(self, user_id: int, payload: dict):
-        for ws in list(self.active.get(user_id, [])):
+        # Encode once; every socket (or the Redis hop) shares the same bytes
+        data = orjson.dumps(payload)
+        if self.redis is not None:
+            await self.redis.publish(_user_channel(user_id), data)
+        else:
+            await self._deliver(user_id, data)
+
+    async def invalidate_user(self, user_id: int):
+        # Other workers drop their cached copy of the user's tunes
+        if self.redis is not None:
+            await self.redis.publish(USER_INVALIDATE_CHANNEL, str(user_id))
+
+    async def _deliver(self, user_id: int, data: bytes):
+        sockets = list(self.active.get(user_id, []))
+        results = await asyncio.gather(*(ws.send_bytes(data) for ws in sockets), return_exceptions=True)
+        for ws, result in zip(sockets, results):
+            if isinstance(result, Exception):
+                # drop broken sockets silently
+                await self.disconnect(user_id, ws)
+
+    async def _listen(self):
+        while True:
+            if not self.pubsub.subscribed:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except aioredis.ConnectionError:
+                await asyncio.sleep(1.0)
+                continue
+            if message is None:
+                continue
             try:
-                await ws.send_json(payload)
+                await self._dispatch(message)
             except Exception:
-                # drop broken sockets silently
-                self.disconnect(user_id, ws)
+                # one bad message or failed unsubscribe must not stop cross-worker delivery
+                logger.exception("Failed to dispatch pub/sub message on %r", message.get("channel"))
+
+    async def _dispatch(self, message: dict):
+        if message["channel"] == USER_INVALIDATE_CHANNEL.encode():
+            crud.invalidate_user(int(message["data"]))
+            return
+        user_id = int(message["channel"].rsplit(b":", 1)[1])
+        await self._deliver(user_id, message["data"])
+
+    @staticmethod
+    def _listener_done(task: asyncio.Task):
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None:
+            logger.error("Pub/sub listener stopped", exc_info=exc)
+        else:
+            logger.error("Pub/sub listener stopped unexpectedly")
 
 manager = ConnectionManager()
 
+def _chunk_forwarder(
+    target_id: int, pending_id: str, sender_id: int, recipient_id: int, stage: str
+) -> DeltaCallback:
+    async def forward(delta: str):
+        await manager.send_to_user(
+            target_id,
+            {
+                "type": "message_chunk",
+                "id": pending_id,
+                "stage": stage,
+                "sender_id": sender_id,
+                "recipient_id": recipient_id,
+                "delta": delta,
+            },
+        )
+    return forward
+
 @app.websocket("/ws/{user_id}")
 async def ws_endpoint(websocket: WebSocket, user_id: int):
     await manager.connect(user_id, websocket)
@@ -277,11 +539,11 @@ async def ws_endpoint(websocket: WebSocket, user_id: int):
         peer_id = None
         while True:
             raw = await websocket.receive_text()
-            data = json.loads(raw)
+            data = orjson.loads(raw)
 
             if data.get("type") == "join":
                 peer_id = int(data.get("peer_id", 0))
-                await websocket.send_json({"type": "joined", "ok": True, "peer_id": peer_id})
+                await _send(websocket, {"type": "joined", "ok": True, "peer_id": peer_id})
 
             elif data.get("type") == "send":
                 sender_id = user_id
@@ -289,22 +551,34 @@ async def ws_endpoint(websocket: WebSocket, user_id: int):
                 text = (data.get("text") or "").strip()
                 if not text:
                     continue
+                # Clients opt in to receiving rewrite tokens as message_chunk events
+                pending_id = uuid.uuid4().hex
+                stream = bool(data.get("stream"))
 
                 # Fetch recipient instruction and apply outgoing/incoming tunes
                 async with AsyncSessionLocal() as db:
-                    recipient = await db.get(models.User, recipient_id)
+                    participants = await crud.get_users_cached(db, [sender_id, recipient_id])
+                    recipient = participants.get(recipient_id)
                     if not recipient:
-                        await websocket.send_json({"type": "error", "detail": "recipient_not_found"})
+                        await _send(websocket, {"type": "error", "detail": "recipient_not_found"})
                         continue
-                    sender = await db.get(models.User, sender_id)
+                    sender = participants.get(sender_id)
                     sender_outgoing = sender.outgoing_instruction if sender else ""
                     recipient_incoming = recipient.instruction or ""
 
-                    outgoing_text, _, outgoing_error = await _rewrite_text(text, sender_outgoing)
-                    final_text, _, incoming_error = await _rewrite_text(outgoing_text, recipient_incoming)
+                    outgoing_chunks = incoming_chunks = None
+                    if stream:
+                        outgoing_chunks = _chunk_forwarder(sender_id, pending_id, sender_id, recipient_id, "outgoing")
+                        incoming_chunks = _chunk_forwarder(recipient_id, pending_id, sender_id, recipient_id, "incoming")
+
+                    outgoing_text, _, outgoing_error = await _rewrite_text(text, sender_outgoing, outgoing_chunks)
+                    final_text, _, incoming_error = await _rewrite_text(
+                        outgoing_text, recipient_incoming, incoming_chunks
+                    )
 
                     if outgoing_error or incoming_error:
-                        await websocket.send_json(
+                        await _send(
+                            websocket,
                             {
                                 "type": "error",
                                 "detail": "rewrite_failed",
@@ -328,6 +602,7 @@ async def ws_endpoint(websocket: WebSocket, user_id: int):
                     payload_sender = {
                         "type": "message",
                         "id": msg.id,
+                        "pending_id": pending_id,
                         "sender_id": sender_id,
                         "recipient_id": recipient_id,
                         "text": outgoing_text,
@@ -339,6 +614,7 @@ async def ws_endpoint(websocket: WebSocket, user_id: int):
                     payload_recipient = {
                         "type": "message",
                         "id": msg.id,
+                        "pending_id": pending_id,
                         "sender_id": sender_id,
                         "recipient_id": recipient_id,
                         "text": final_text,
@@ -351,10 +627,24 @@ async def ws_endpoint(websocket: WebSocket, user_id: int):
                     await manager.send_to_user(recipient_id, payload_recipient)
 
             else:
-                await websocket.send_json({"type": "error", "detail": "unknown_type"})
+                await _send(websocket, {"type": "error", "detail": "unknown_type"})
     except WebSocketDisconnect:
         pass
     finally:
-        manager.disconnect(user_id, websocket)
-
-app.mount("/", StaticFiles(directory="static", html=True), name="static-root")
+        await manager.disconnect(user_id, websocket)
+
+app.mount("/", static_files, name="static-root")
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        # uvicorn creates the loop before importing the app, so the loop is chosen here
+        loop="uvloop" if sys.platform != "win32" else "asyncio",
+        http="httptools",
+        ws="websockets",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+    )
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index, PrimaryKeyConstraint
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from database import Base
 
@@ -11,6 +12,12 @@ class User(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        Index("ix_msg_sender_recipient_ts", "sender_id", "recipient_id", "timestamp"),
+        Index("ix_msg_recipient_sender_ts", "recipient_id", "sender_id", "timestamp"),
+        Index("ix_msg_participant_ts", "sender_id", "timestamp"),
+        Index("ix_msg_recipient_ts", "recipient_id", "timestamp"),
+    )
     id = Column(Integer, primary_key=True)
     sender_id = Column(Integer, ForeignKey("users.id"))
     recipient_id = Column(Integer, ForeignKey("users.id"))
@@ -20,3 +27,20 @@ class Message(Base):
     instruction_used = Column(Text)
     outgoing_instruction_used = Column(Text)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
+
+    # lazy="raise" turns any accidental per-row lazy load into an error; callers
+    # that read these must eager-load them with selectinload().
+    sender = relationship("User", foreign_keys=[sender_id], lazy="raise")
+    recipient = relationship("User", foreign_keys=[recipient_id], lazy="raise")
+
+class ConversationState(Base):
+    """Last message per user pair, kept current by the message write path.
+
+    Each pair is stored once with user_a <= user_b.
+    """
+    __tablename__ = "conversation_state"
+    __table_args__ = (PrimaryKeyConstraint("user_a", "user_b"),)
+    user_a = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_b = Column(Integer, ForeignKey("users.id"), nullable=False)
+    last_message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)
+    last_timestamp = Column(DateTime(timezone=True))
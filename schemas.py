@@ -1,7 +1,7 @@
 from typing import Optional
 from datetime import datetime
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, TypeAdapter
 
 class UserCreate(BaseModel):
     nickname: str
@@ -12,8 +12,7 @@ class UserOut(BaseModel):
     instruction: str
     outgoing_instruction: str
     is_online: bool = False
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class MessageCreate(BaseModel):
     sender_id: int
@@ -29,8 +28,7 @@ class MessageOut(BaseModel):
     rephrased_text: str
     instruction_used: Optional[str] = None
     outgoing_instruction_used: Optional[str] = None
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class ConversationSummary(BaseModel):
     peer_id: int
@@ -40,3 +38,8 @@ class ConversationSummary(BaseModel):
     last_message_sender_id: Optional[int] = None
     last_message_text: Optional[str] = None
     last_message_timestamp: Optional[datetime] = None
+
+# Prebuilt adapters let list endpoints validate and serialize in one pydantic-core pass
+USERS_ADAPTER = TypeAdapter(list[UserOut])
+MESSAGES_ADAPTER = TypeAdapter(list[MessageOut])
+CONVERSATIONS_ADAPTER = TypeAdapter(list[ConversationSummary])